@@ -0,0 +1,158 @@
+"""
+Stacked inference for the exported Dry Eye Disease ensemble
+Usage: python predict.py input.csv [model_dir] [forest|onnx]
+"""
+
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import onnxruntime as ort
+from numba import njit, prange
+import tensorflow as tf
+
+
+def encode_features(df, features):
+    """Encode Y/N, Gender and Blood pressure columns; shared with train_model.py"""
+    df = df.copy()
+
+    # Auto-detect and encode ALL Y/N columns FIRST (one vectorized pass)
+    obj = df.select_dtypes(include='object').columns
+    yn_mask = (df[obj].isin(['Y', 'N']) | df[obj].isna()).all(axis=0)
+    yn_cols = obj[yn_mask.to_numpy()]
+    if len(yn_cols):
+        yn = df[yn_cols]
+        df[yn_cols] = yn.eq('Y').astype('int8').mask(yn.isna())
+
+    # Gender encoding (M/F support)
+    if 'Gender' in df.columns:
+        df['Gender'] = df['Gender'].map({'M': 1, 'Male': 1, 'F': 0, 'Female': 0}).astype(float)
+
+    # Blood pressure split AFTER Y/N encoding, only when a derived column is used
+    if 'Blood pressure' in df.columns and {'Systolic_BP', 'Diastolic_BP'} & set(features):
+        bp = df['Blood pressure'].str.extract(r'(?P<Systolic_BP>\d+)/(?P<Diastolic_BP>\d+)')
+        bp = bp.astype('float32')
+        # int16 only when every cell parsed; blank or malformed ones stay NaN
+        df[['Systolic_BP', 'Diastolic_BP']] = bp if bp.isna().to_numpy().any() else bp.astype('int16')
+        df = df.drop(columns='Blood pressure')
+
+    return df
+
+
+# fastmath without the no-NaN flag, which would fold away the isnan check
+@njit(parallel=True, fastmath={'contract', 'reassoc', 'arcp'})
+def score_forest(X, feat, thr, missing_left, left, right, leaf, tree_offsets, bias, out):
+    """Sum leaf values over all trees for each row of X and write the margin to out"""
+    for i in prange(X.shape[0]):
+        total = 0.0
+        for t in range(tree_offsets.shape[0] - 1):
+            base = tree_offsets[t]
+            node = 0
+            # Child indices are local to the tree; -1 marks a leaf
+            while left[base + node] != -1:
+                x = X[i, feat[base + node]]
+                if np.isnan(x):
+                    go_left = missing_left[base + node]
+                else:
+                    go_left = x <= thr[base + node]
+                node = left[base + node] if go_left else right[base + node]
+            total += leaf[base + node]
+        out[i] = bias + total
+
+
+def forest_margins(forest, X, out):
+    """Score X with one flattened forest (as saved in base_model_<name>_forest.npz)"""
+    score_forest(X, forest['feat'], forest['thr'], forest['missing_left'], forest['left'],
+                 forest['right'], forest['leaf'], forest['tree_offsets'], float(forest['bias']), out)
+
+
+def _positive_score(scores):
+    """Positive-class column from either a tensor or a ZipMap (list of dicts) output"""
+    if isinstance(scores, list):
+        return np.array([row[1] for row in scores], dtype=np.float64)
+    return np.asarray(scores, dtype=np.float64)[:, 1]
+
+
+def onnx_margins(session, X):
+    """Raw positive-class margins from an exported base model"""
+    # Exported with post_transform NONE, so the scores output holds margins
+    outputs = session.run(None, {session.get_inputs()[0].name: X})
+    return _positive_score(outputs[1])
+
+
+class StackingEnsemblePredictor:
+    def __init__(self, model_dir='stacking_ensemble_model', backend='forest', batch_size=4096):
+        if backend not in ('forest', 'onnx'):
+            raise ValueError(f"Unknown backend: {backend}")
+        self.backend = backend
+        self.batch_size = batch_size
+
+        with open(os.path.join(model_dir, 'config.json'), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        self.features = self.config['features']
+
+        scaler = np.load(os.path.join(model_dir, 'scaler.npz'))
+        self.mean = scaler['mean']
+        self.scale = scaler['scale']
+
+        # Base models: flattened forests for the Numba kernel, or ONNX sessions
+        names = [name.lower() for name in self.config['base_models']]
+        if backend == 'forest':
+            self.base_models = [dict(np.load(os.path.join(model_dir, f'base_model_{name}_forest.npz')))
+                                for name in names]
+        else:
+            unverified = set(self.config['base_models']) - set(self.config.get('onnx_models', []))
+            if unverified:
+                raise ValueError(f"ONNX exports failed the parity check: {sorted(unverified)}; "
+                                 f"use the forest backend")
+            self.base_models = [
+                ort.InferenceSession(os.path.join(model_dir, f'base_model_{name}.onnx'),
+                                     providers=['CPUExecutionProvider'])
+                for name in names
+            ]
+        self.nn_model = tf.keras.models.load_model(os.path.join(model_dir, 'nn_meta_learner.h5'),
+                                                   compile=False)
+        print(f"✓ Loaded {len(self.base_models)} base models ({backend}) from {model_dir}/")
+
+    def transform(self, X):
+        """StandardScaler.transform: float64 (x - mean) / scale, then cast to float32"""
+        # A float32 multiply by 1/scale lands one ulp off the training values
+        # often enough to send rows down the wrong side of a split
+        return ((np.asarray(X, dtype=np.float64) - self.mean) / self.scale).astype(np.float32)
+
+    def predict_proba(self, X):
+        """Probability of Dry Eye Disease for encoded feature rows"""
+        X = self.transform(X)
+        proba = np.empty(len(X), dtype=np.float32)
+        for start in range(0, len(X), self.batch_size):
+            stop = start + self.batch_size
+            proba[start:stop] = self._predict_batch(X[start:stop])
+        return proba
+
+    def _predict_batch(self, X):
+        n_features = X.shape[1]
+        X_nn = np.empty((len(X), n_features + len(self.base_models)), dtype=np.float32)
+        X_nn[:, :n_features] = X
+
+        for j, model in enumerate(self.base_models):
+            if self.backend == 'forest':
+                # Raw margins written straight into the NN input column
+                forest_margins(model, X, X_nn[:, n_features + j])
+            else:
+                X_nn[:, n_features + j] = onnx_margins(model, X)
+        return self.nn_model(X_nn, training=False).numpy().ravel()
+
+
+if __name__ == '__main__':
+    input_path = sys.argv[1]
+    model_dir = sys.argv[2] if len(sys.argv) > 2 else 'stacking_ensemble_model'
+    backend = sys.argv[3] if len(sys.argv) > 3 else 'forest'
+
+    predictor = StackingEnsemblePredictor(model_dir, backend)
+    X = encode_features(pd.read_csv(input_path), predictor.features)[predictor.features]
+    proba = predictor.predict_proba(X)
+
+    output = pd.DataFrame({'DED_probability': proba, 'DED_prediction': (proba > 0.5).astype(int)})
+    output.to_csv('predictions.csv', index=False)
+    print(f"✓ Predicted {len(output)} rows → predictions.csv")
@@ -1,6 +1,7 @@
 """
 Stacking Ensemble Trainer for Dry Eye Disease Prediction
 Usage: python train_model.py
+       USE_GPU=1 python train_model.py   (GPU training for XGBoost/LightGBM/CatBoost)
 """
 
 import pandas as pd
@@ -8,22 +9,335 @@ import numpy as np
 import json
 import os
 import pickle
+import hashlib
+import tempfile
+import joblib
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from sklearn.base import clone
 from sklearn.model_selection import StratifiedKFold
+from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import StandardScaler
+from sklearn.utils.class_weight import compute_class_weight
 from sklearn.metrics import accuracy_score, recall_score, f1_score, confusion_matrix
-from sklearn.ensemble import GradientBoostingClassifier, HistGradientBoostingClassifier
-from imblearn.over_sampling import SMOTE, RandomOverSampler
+from sklearn.ensemble import HistGradientBoostingClassifier
+import xgboost as xgb
+import lightgbm as lgb
 from xgboost import XGBClassifier
 from lightgbm import LGBMClassifier
 from catboost import CatBoostClassifier
+import onnx
+import onnxruntime as ort
+from onnxmltools import convert_xgboost, convert_lightgbm
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
 import tensorflow as tf
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout, BatchNormalization
+from tensorflow.keras.layers import Input, Dense, Dropout, BatchNormalization, Activation
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
+from predict import StackingEnsemblePredictor, encode_features, forest_margins, onnx_margins
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
 np.random.seed(42)
 tf.random.set_seed(42)
 
+# FP16 matmuls on Tensor Cores; float16 compute on CPU would only be slower
+if tf.config.list_physical_devices('GPU'):
+    tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
+
+def _minority_neighbors(X, y, n_candidates=15):
+    """Build the minority-class k-NN graph once, shared by every fold's SMOTE"""
+    minority = np.argmin(np.bincount(y))
+    minority_idx = np.flatnonzero(y == minority)
+    nn = NearestNeighbors(n_neighbors=n_candidates + 1, algorithm='ball_tree', n_jobs=-1)
+    nn.fit(X[minority_idx])
+    # Column 0 is the sample itself; the rest index into minority_idx
+    neighbors = nn.kneighbors(X[minority_idx], return_distance=False)[:, 1:]
+    return minority, minority_idx, neighbors
+
+
+def _smote(X, y, train_mask, minority_graph, sampling_strategy, k_neighbors=5, seed=42):
+    """SMOTE restricted to train_mask rows, reusing the precomputed k-NN graph"""
+    minority, minority_idx, neighbors = minority_graph
+    X_train, y_train = X[train_mask], y[train_mask]
+    n_minority = np.count_nonzero(y_train == minority)
+    n_new = int(sampling_strategy * (len(y_train) - n_minority) - n_minority)
+    if n_new <= 0:
+        return X_train, y_train
+    
+    # Only training-fold neighbours are eligible; keep the first k of them
+    in_train = train_mask[minority_idx]
+    samples = minority_idx[in_train]
+    candidates = neighbors[in_train]
+    valid = in_train[candidates]
+    rank = np.cumsum(valid, axis=1)
+    n_valid = np.minimum(rank[:, -1], k_neighbors)
+    
+    # Interpolate between a random sample and one of its k neighbours
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(np.flatnonzero(n_valid > 0), size=n_new)
+    picks = rng.integers(0, n_valid[rows]) + 1
+    cols = np.argmax(valid[rows] & (rank[rows] == picks[:, None]), axis=1)
+    base = X[samples[rows]]
+    nbr = X[minority_idx[candidates[rows, cols]]]
+    # Draw the gaps in X's dtype so the float32 matrix is not upcast by vstack
+    X_new = base + rng.random((n_new, 1), dtype=X.dtype) * (nbr - base)
+    
+    X_sm = np.vstack((X_train, X_new))
+    y_sm = np.concatenate((y_train, np.full(n_new, minority, dtype=y.dtype)))
+    return X_sm, y_sm
+
+
+def _predict_meta(model, X):
+    """Raw positive-class margin of a base model, fed to the meta-learner"""
+    if isinstance(model, XGBClassifier):
+        return model.predict(X, output_margin=True)
+    if isinstance(model, (LGBMClassifier, lgb.Booster)):
+        return model.predict(X, raw_score=True)
+    if isinstance(model, CatBoostClassifier):
+        return model.predict(X, prediction_type='RawFormulaVal')
+    return model.decision_function(X)
+
+
+def _tree():
+    return {'feat': [], 'thr': [], 'missing_left': [], 'left': [], 'right': [], 'leaf': []}
+
+
+def _add_node(tree, feat=0, thr=0.0, missing_left=False, leaf=0.0):
+    """Append a node (a leaf until its children are set) and return its index"""
+    tree['feat'].append(feat)
+    tree['thr'].append(thr)
+    tree['missing_left'].append(missing_left)
+    tree['left'].append(-1)
+    tree['right'].append(-1)
+    tree['leaf'].append(leaf)
+    return len(tree['feat']) - 1
+
+
+def _trees_xgboost(model):
+    booster = model.get_booster()
+    # base_score is stored as a probability (newer versions wrap it in [])
+    learner = json.loads(booster.save_config())['learner']
+    base_score = float(str(learner['learner_model_param']['base_score']).strip('[]'))
+    bias = np.log(base_score / (1 - base_score))
+    
+    trees = []
+    df = booster.trees_to_dataframe()
+    for _, nodes in df.sort_values(['Tree', 'Node']).groupby('Tree'):
+        tree = _tree()
+        pos = {node_id: i for i, node_id in enumerate(nodes['ID'])}
+        for row in nodes.itertuples():
+            if row.Feature == 'Leaf':
+                _add_node(tree, leaf=row.Gain)
+                continue
+            # XGBoost goes left on x < split; the kernel tests x <= thr
+            thr = np.nextafter(np.float32(row.Split), np.float32(-np.inf))
+            i = _add_node(tree, int(row.Feature[1:]), float(thr), row.Missing == row.Yes)
+            tree['left'][i], tree['right'][i] = pos[row.Yes], pos[row.No]
+        trees.append(tree)
+    return trees, float(bias)
+
+
+def _trees_lightgbm(model):
+    def walk(tree, node):
+        if 'leaf_value' in node:
+            return _add_node(tree, leaf=node['leaf_value'])
+        # 'Zero' (zero_as_missing) also routes real zeros by default_left,
+        # which the kernel's NaN-only missing check cannot express
+        if node['missing_type'] == 'NaN':
+            missing_left = node['default_left']
+        elif node['missing_type'] == 'None':
+            # Without NaN-aware splits LightGBM scores NaN as 0
+            missing_left = 0.0 <= node['threshold']
+        else:
+            raise ValueError(f"Unsupported LightGBM missing type: {node['missing_type']}")
+        i = _add_node(tree, node['split_feature'], node['threshold'], missing_left)
+        tree['left'][i] = walk(tree, node['left_child'])
+        tree['right'][i] = walk(tree, node['right_child'])
+        return i
+    
+    # LightGBM folds its init score into the first tree's leaves
+    trees = []
+    booster = model.booster_ if isinstance(model, LGBMClassifier) else model
+    for info in booster.dump_model()['tree_info']:
+        tree = _tree()
+        walk(tree, info['tree_structure'])
+        trees.append(tree)
+    return trees, 0.0
+
+
+def _trees_catboost(model):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.json')
+        model.save_model(path, format='json')
+        with open(path, 'r', encoding='utf-8') as f:
+            dump = json.load(f)
+    float_features = {info['feature_index']: info for info in dump['features_info']['float_features']}
+    scale, bias = dump.get('scale_and_bias', [1.0, [0.0]])
+    if isinstance(bias, list):
+        bias = bias[0] if bias else 0.0
+    
+    # Oblivious tree: level d applies splits[d] and sets bit d of the leaf index
+    def expand(tree, splits, values, level, leaf_idx):
+        if level == len(splits):
+            return _add_node(tree, leaf=scale * values[leaf_idx])
+        split = splits[level]
+        if split['split_type'] != 'FloatFeature':
+            raise ValueError(f"Unsupported CatBoost split type: {split['split_type']}")
+        info = float_features[split['float_feature_index']]
+        missing_left = info.get('nan_value_treatment', 'AsFalse') != 'AsTrue'
+        i = _add_node(tree, info['flat_feature_index'], split['border'], missing_left)
+        tree['left'][i] = expand(tree, splits, values, level + 1, leaf_idx)
+        tree['right'][i] = expand(tree, splits, values, level + 1, leaf_idx | (1 << level))
+        return i
+    
+    trees = []
+    for oblivious in dump['oblivious_trees']:
+        tree = _tree()
+        expand(tree, oblivious.get('splits', []), oblivious['leaf_values'], 0, 0)
+        trees.append(tree)
+    return trees, float(bias)
+
+
+def _trees_histgb(model):
+    trees = []
+    for (predictor,) in model._predictors:
+        nodes = predictor.nodes
+        leaf = nodes['is_leaf'].astype(bool)
+        trees.append({
+            'feat': nodes['feature_idx'],
+            'thr': nodes['num_threshold'],
+            'missing_left': nodes['missing_go_to_left'],
+            'left': np.where(leaf, -1, nodes['left']),
+            'right': np.where(leaf, -1, nodes['right']),
+            'leaf': nodes['value'],
+        })
+    return trees, float(np.ravel(model._baseline_prediction)[0])
+
+
+def _extract_forest(model):
+    """Flatten a fitted booster into the node arrays walked by score_forest"""
+    if isinstance(model, XGBClassifier):
+        trees, bias = _trees_xgboost(model)
+    elif isinstance(model, (LGBMClassifier, lgb.Booster)):
+        trees, bias = _trees_lightgbm(model)
+    elif isinstance(model, CatBoostClassifier):
+        trees, bias = _trees_catboost(model)
+    else:
+        trees, bias = _trees_histgb(model)
+    
+    sizes = [len(tree['feat']) for tree in trees]
+    return {
+        'feat': np.concatenate([tree['feat'] for tree in trees]).astype(np.int32),
+        'thr': np.concatenate([tree['thr'] for tree in trees]).astype(np.float64),
+        'missing_left': np.concatenate([tree['missing_left'] for tree in trees]).astype(bool),
+        'left': np.concatenate([tree['left'] for tree in trees]).astype(np.int32),
+        'right': np.concatenate([tree['right'] for tree in trees]).astype(np.int32),
+        'leaf': np.concatenate([tree['leaf'] for tree in trees]).astype(np.float64),
+        'tree_offsets': np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+        'bias': bias,
+    }
+
+
+def _export_onnx(model, path, n_features):
+    """Write a fitted base model as an ONNX classifier whose scores are raw margins"""
+    initial_types = [('input', FloatTensorType([None, n_features]))]
+    if isinstance(model, CatBoostClassifier):
+        model.save_model(path, format='onnx')
+        onx = onnx.load(path)
+    elif isinstance(model, XGBClassifier):
+        onx = convert_xgboost(model, initial_types=initial_types)
+    elif isinstance(model, (LGBMClassifier, lgb.Booster)):
+        onx = convert_lightgbm(model, initial_types=initial_types, zipmap=False)
+    else:
+        onx = convert_sklearn(model, initial_types=initial_types,
+                              options={id(model): {'zipmap': False, 'raw_scores': True}})
+    
+    # The sigmoid is the tree ensemble's post_transform; without it the
+    # positive-class score is the margin the meta-learner was trained on
+    for node in onx.graph.node:
+        if node.op_type == 'TreeEnsembleClassifier':
+            for attr in node.attribute:
+                if attr.name == 'post_transform':
+                    attr.s = b'NONE'
+    onnx.save_model(onx, path)
+
+
+def _proba_tolerance():
+    """Allowed meta-learner probability gap; float16 compute under mixed precision widens it"""
+    mixed = tf.keras.mixed_precision.global_policy().compute_dtype == 'float16'
+    return 1e-2 if mixed else 1e-4
+
+
+def _fit_one(model_proto, name, fold, X_all, y_all, train_idx, val_idx, n_threads):
+    """Fit a fresh clone of one base model on a SMOTE-resampled fold"""
+    model = clone(model_proto)
+    if isinstance(model, CatBoostClassifier):
+        model.set_params(thread_count=n_threads)
+    # OpenMP thread counts are per OS thread, so HistGBC is capped here
+    with threadpool_limits(limits=n_threads, user_api='openmp'):
+        model.fit(X_all[train_idx], y_all[train_idx])
+        margins = _predict_meta(model, X_all[val_idx])
+    return name, fold, margins, model
+
+
+def _fold_matrix(X, y, fold_id, n_splits, minority_graph, sampling_strategy):
+    """Stack X with every fold's SMOTE rows, plus (train, val) indices into the stack per fold"""
+    parts, labels, folds = [X], [y], []
+    offset = len(y)
+    for fold in range(n_splits):
+        val_mask = fold_id == fold
+        X_sm, y_sm = _smote(X, y, ~val_mask, minority_graph, sampling_strategy)
+        # _smote appends its synthetic rows after the training rows
+        n_train = np.count_nonzero(~val_mask)
+        n_new = len(y_sm) - n_train
+        parts.append(X_sm[n_train:])
+        labels.append(y_sm[n_train:])
+        train_idx = np.concatenate((np.flatnonzero(~val_mask), offset + np.arange(n_new)))
+        folds.append((train_idx, np.flatnonzero(val_mask)))
+        offset += n_new
+    return np.vstack(parts), np.concatenate(labels), folds
+
+
+class _KeepBoosters(xgb.callback.TrainingCallback):
+    """Capture the per-fold boosters that xgb.cv otherwise discards"""
+    def after_training(self, model):
+        self.boosters = [fold.bst for fold in model.cvfolds]
+        return model
+
+
+def _cv_xgboost(model_proto, X_all, y_all, folds):
+    params = {**model_proto.get_xgb_params(), 'nthread': os.cpu_count()}
+    params.pop('n_jobs', None)
+    if cupy is not None and params.get('device') == 'cuda':
+        # XGBoost builds its histograms straight from device memory
+        X_all = cupy.asarray(X_all)
+    keep = _KeepBoosters()
+    xgb.cv(params, xgb.DMatrix(X_all, label=y_all), num_boost_round=model_proto.n_estimators,
+           folds=folds, callbacks=[keep])
+    
+    # Back into the sklearn wrapper so saving and export stay unchanged
+    models = []
+    for booster in keep.boosters:
+        model = clone(model_proto)
+        model.load_model(bytearray(booster.save_raw()))
+        models.append(model)
+    return models
+
+
+def _cv_lightgbm(model_config, X_all, y_all, folds):
+    params = {k: v for k, v in model_config.items() if k != 'n_estimators'}
+    params.update(objective='binary', num_threads=os.cpu_count())
+    # Fold subsets share the bin mappers of the full Dataset
+    result = lgb.cv(params, lgb.Dataset(X_all, label=y_all), num_boost_round=model_config['n_estimators'],
+                    folds=folds, return_cvbooster=True)
+    return result['cvbooster'].boosters
+
 
 class StackingEnsembleTrainer:
     def __init__(self, config_path='training_config.json', data_path='Dry_Eye_Dataset.csv'):
@@ -41,46 +355,82 @@ class StackingEnsembleTrainer:
         self.base_models_config = self.config['base_models']
         self.target_col = self.config['dataset']['target_column']
         
-        print(f"✓ Loaded config from {self.config_path}")
-        print(f"✓ Features: {len(self.features)}")
-        
-    def preprocess_data(self):
-        """Load and preprocess data based on config"""
-        df = pd.read_csv(self.data_path)
+        # GPU parameter blocks for the gradient boosters (opt-in via USE_GPU=1)
+        self.use_gpu = os.environ.get('USE_GPU', '0') == '1'
+        if self.use_gpu:
+            for key, params in self.config['base_models_gpu'].items():
+                self.base_models_config[key] = {**self.base_models_config[key], **params}
         
-        # Auto-detect and encode ALL Y/N columns FIRST
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                unique_vals = set(df[col].dropna().unique())
-                if unique_vals.issubset({'Y', 'N'}):
-                    df[col] = df[col].map({'Y': 1, 'N': 0})
+        # Columns actually used downstream; the rest are never parsed
+        bp_config = self.preprocessing_config['blood_pressure_split']
+        derived = set(bp_config['new_columns'])
+        self.read_columns = [col for col in self.features if col not in derived]
+        if derived & set(self.features):
+            self.read_columns.append(bp_config['source_column'])
+        self.read_columns += [self.target_col, 'Dry Eye Disease']
         
-        # Gender encoding (M/F support)
-        if 'Gender' in df.columns:
-            df['Gender'] = df['Gender'].map({'M': 1, 'Male': 1, 'F': 0, 'Female': 0})
-        
-        # Blood pressure split AFTER Y/N encoding
-        if 'Blood pressure' in df.columns:
-            df[['Systolic_BP', 'Diastolic_BP']] = df['Blood pressure'].str.split('/', expand=True).astype(float)
+        print(f"✓ Loaded config from {self.config_path}")
+        print(f"✓ Features: {len(self.features)}")
+        print(f"✓ Boosters on: {'GPU' if self.use_gpu else 'CPU'}")
+        
+    def preprocess_data(self, cache_dir='.cache'):
+        """Load, preprocess and scale data, reusing the on-disk cache when valid"""
+        with open(self.data_path, 'rb') as f:
+            cache_spec = {'features': self.features, 'dtype': 'float32'}
+            digest = hashlib.blake2b(f.read() + json.dumps(cache_spec).encode())
+        key = digest.hexdigest()[:16]
+        X_path = os.path.join(cache_dir, f'{key}_X.npy')
+        y_path = os.path.join(cache_dir, f'{key}_y.npy')
+        scaler_path = os.path.join(cache_dir, f'{key}_scaler.pkl')
+        
+        if all(os.path.exists(p) for p in (X_path, y_path, scaler_path)):
+            self.scaler = joblib.load(scaler_path)
+            print(f"✓ Loaded preprocessed data from {cache_dir}/ ({key})")
+        else:
+            X, y = self._load_dataset()
+            self.scaler = StandardScaler()
+            os.makedirs(cache_dir, exist_ok=True)
+            X_scaled = self.scaler.fit_transform(X).astype(np.float32, copy=False)
+            np.save(X_path, X_scaled)
+            np.save(y_path, y)
+            joblib.dump(self.scaler, scaler_path)
+        
+        # Memory-mapped so folds read the scaled matrix straight from the page cache
+        self.X_scaled = np.load(X_path, mmap_mode='r')
+        self.y = np.load(y_path)
+        
+        # Two-valued columns (Y/N flags, Gender) need a single quantization border
+        self.binary_features = [j for j in range(self.X_scaled.shape[1])
+                                if len(np.unique(self.X_scaled[:, j])) <= 2]
+        print(f"✓ Data shape: {self.X_scaled.shape}, Classes: 0={sum(self.y==0)}, 1={sum(self.y==1)}")
+        
+    def _load_dataset(self):
+        """Read the CSV and encode the configured features"""
+        header = pd.read_csv(self.data_path, nrows=0).columns
+        usecols = [col for col in self.read_columns if col in header]
+        df = pd.read_csv(self.data_path, engine='pyarrow', usecols=usecols,
+                         dtype={'Gender': 'category'})
+        
+        df = encode_features(df, self.features)
         
         # Handle target column name mismatch
         if 'Dry Eye Disease' in df.columns and 'Dry_Eye_Disease' not in df.columns:
             df['Dry_Eye_Disease'] = df['Dry Eye Disease']
         
-        self.X = df[self.features].copy()
-        self.y = df['Dry_Eye_Disease'].copy()
-        print(f"✓ Data shape: {self.X.shape}, Classes: 0={sum(self.y==0)}, 1={sum(self.y==1)}")
+        return df[self.features], df['Dry_Eye_Disease'].to_numpy()
         
     def init_base_models(self):
         """Initialize base models from config"""
         self.base_models = [
             XGBClassifier(**self.base_models_config['xgboost']),
             LGBMClassifier(**self.base_models_config['lightgbm']),
-            CatBoostClassifier(**self.base_models_config['catboost']),
-            GradientBoostingClassifier(**self.base_models_config['gradientboosting']),
-            HistGradientBoostingClassifier(**self.base_models_config['histgradientboosting'])
+            CatBoostClassifier(**self.base_models_config['catboost'],
+                               per_float_feature_quantization=[
+                                   f'{j}:border_count=1' for j in self.binary_features] or None),
+            HistGradientBoostingClassifier(**self.base_models_config['histgradientboosting']),
+            HistGradientBoostingClassifier(**self.base_models_config['histgradientboosting2'])
         ]
-        self.base_names = ['XGBoost', 'LightGBM', 'CatBoost', 'GradientBoosting', 'HistGradientBoosting']
+        self.base_names = ['XGBoost', 'LightGBM', 'CatBoost', 'HistGradientBoosting', 'HistGradientBoosting2']
         print(f"✓ Initialized {len(self.base_models)} base models")
         
     def train_base_models(self, n_splits=5):
@@ -88,37 +438,68 @@ class StackingEnsembleTrainer:
         print(f"\n[K-Fold CV: {n_splits} folds]")
         kf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
         
-        # Scale data
-        self.scaler = StandardScaler()
-        X_scaled = self.scaler.fit_transform(self.X)
-        
-        # OOF predictions
-        oof_preds = {name: np.zeros(len(self.y)) for name in self.base_names}
-        
-        for fold, (train_idx, val_idx) in enumerate(kf.split(X_scaled, self.y), 1):
-            X_train, X_val = X_scaled[train_idx], X_scaled[val_idx]
-            y_train, y_val = self.y.iloc[train_idx], self.y.iloc[val_idx]
-            
-            # SMOTE
-            smote = SMOTE(sampling_strategy=0.7, random_state=42)
-            X_train_sm, y_train_sm = smote.fit_resample(X_train, y_train)
-            
-            # Train each model
-            for model, name in zip(self.base_models, self.base_names):
-                model.fit(X_train_sm, y_train_sm)
-                oof_preds[name][val_idx] = model.predict_proba(X_val)[:, 1]
-            
-            print(f"Fold {fold} completed")
-        
-        # Prepare NN input
-        oof_array = np.column_stack([oof_preds[name] for name in self.base_names])
-        self.X_nn = np.column_stack((X_scaled, oof_array))
+        X_scaled, y = self.X_scaled, self.y
+        
+        # Fold assignment per row, computed once; _fold_matrix turns it into
+        # (train, val) index arrays into the shared matrix of X plus SMOTE rows
+        self.fold_id = np.empty(len(y), dtype=np.int8)
+        for fold, (_, val_idx) in enumerate(kf.split(X_scaled, y)):
+            self.fold_id[val_idx] = fold
+        minority_graph = _minority_neighbors(X_scaled, y)
+        
+        # X plus each fold's SMOTE rows, resampled once and shared by all models
+        X_all, y_all, folds = _fold_matrix(X_scaled, y, self.fold_id, n_splits, minority_graph, 0.7)
+        
+        # CatBoost and HistGBC release the GIL while fitting, so the remaining
+        # fold x model fits run on threads over the shared arrays, each capped
+        # to its share of the cores. On GPU they share one device: run serially.
+        cv_models = (XGBClassifier, LGBMClassifier)
+        pooled = [(model, name) for model, name in zip(self.base_models, self.base_names)
+                  if not isinstance(model, cv_models)]
+        n_workers = 1 if self.use_gpu else len(pooled)
+        n_threads = max(1, os.cpu_count() // n_workers)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(_fit_one, model, name, fold, X_all, y_all, train_idx, val_idx, n_threads)
+                for fold, (train_idx, val_idx) in enumerate(folds)
+                for model, name in pooled
+            ]
+            results = [future.result() for future in futures]
+        
+        # XGBoost and LightGBM run all folds in one cv call over a single
+        # DMatrix / Dataset built from the same arrays
+        for model, name in zip(self.base_models, self.base_names):
+            if isinstance(model, XGBClassifier):
+                fold_models = _cv_xgboost(model, X_all, y_all, folds)
+            elif isinstance(model, LGBMClassifier):
+                fold_models = _cv_lightgbm(self.base_models_config['lightgbm'], X_all, y_all, folds)
+            else:
+                continue
+            for fold, (fold_model, (_, val_idx)) in enumerate(zip(fold_models, folds)):
+                results.append((name, fold, _predict_meta(fold_model, X_all[val_idx]), fold_model))
+        del X_all, y_all
+        
+        # NN input allocated once: scaled features, then one OOF margin
+        # column per base model written in place
+        n_features = X_scaled.shape[1]
+        self.X_nn = np.empty((len(y), n_features + len(self.base_names)), dtype=np.float32)
+        self.X_nn[:, :n_features] = X_scaled
+        column = {name: n_features + j for j, name in enumerate(self.base_names)}
+        
+        # Keep the last fold's fitted models for saving
+        fitted = {}
+        for name, fold, margins, model in results:
+            self.X_nn[self.fold_id == fold, column[name]] = margins
+            fitted[name] = model
+        self.base_models = [fitted[name] for name in self.base_names]
+        print(f"✓ {len(results)} fold fits completed")
         print(f"✓ NN input shape: {self.X_nn.shape}")
         
     def build_nn(self):
         """Build Neural Network meta-learner"""
         self.nn_model = Sequential([
-            Dense(256, activation='relu', input_shape=(self.X_nn.shape[1],)),
+            Input(shape=(self.X_nn.shape[1],), dtype='float32'),
+            Dense(256, activation='relu'),
             BatchNormalization(),
             Dropout(0.3),
             Dense(128, activation='relu'),
@@ -127,17 +508,19 @@ class StackingEnsembleTrainer:
             Dense(64, activation='relu'),
             BatchNormalization(),
             Dropout(0.1),
-            Dense(1, activation='sigmoid')
+            # Output stays float32 under mixed precision to keep the loss stable
+            Dense(1, dtype='float32'),
+            Activation('sigmoid', dtype='float32')
         ])
-        self.nn_model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+        self.nn_model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'],
+                              jit_compile=True)
         
     def train_nn(self):
         """Train Neural Network"""
         print("\n[Training Neural Network]")
         
-        # Oversample
-        ros = RandomOverSampler(random_state=42)
-        X_resampled, y_resampled = ros.fit_resample(self.X_nn, self.y)
+        # Rebalance through the loss instead of duplicating minority rows
+        weights = compute_class_weight('balanced', classes=np.array([0, 1]), y=self.y)
         
         # Callbacks
         callbacks = [
@@ -145,11 +528,25 @@ class StackingEnsembleTrainer:
             ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=10, min_lr=1e-5)
         ]
         
+        # Hold out the last 20% like validation_split; batching and shuffling
+        # run in tf.data and are prefetched while the previous step computes
+        n_train = len(self.y) - int(len(self.y) * 0.2)
+        train_ds = (tf.data.Dataset.from_tensor_slices((self.X_nn[:n_train], self.y[:n_train]))
+                    .cache()
+                    .shuffle(n_train, seed=42)
+                    .batch(512)
+                    .prefetch(tf.data.AUTOTUNE))
+        val_ds = (tf.data.Dataset.from_tensor_slices((self.X_nn[n_train:], self.y[n_train:]))
+                  .cache()
+                  .batch(512)
+                  .prefetch(tf.data.AUTOTUNE))
+        
         # Train
         self.history = self.nn_model.fit(
-            X_resampled, y_resampled,
-            epochs=100, batch_size=32,
-            validation_split=0.2,
+            train_ds,
+            epochs=100,
+            validation_data=val_ds,
+            class_weight=dict(enumerate(weights)),
             callbacks=callbacks,
             verbose=1
         )
@@ -175,26 +572,110 @@ class StackingEnsembleTrainer:
         print(f"F1 Macro:      {self.metrics['f1_macro']:.4f}")
         print(f"{'='*60}")
         
-    def save_model(self, output_dir='stacking_ensemble_model'):
+    def fuse_nn(self, n_check=256):
+        """Inference copy of the meta-learner with BatchNormalization and Dropout folded away"""
+        # Each BN follows a ReLU, so it cannot fold into the preceding Dense.
+        # At inference it is the affine map h * a + c, which folds into the
+        # next Dense instead: W' = a[:, None] * W, b' = b + c @ W
+        layers, weights = [Input(shape=(self.X_nn.shape[1],), dtype='float32')], []
+        pending = None
+        for layer in self.nn_model.layers:
+            if isinstance(layer, BatchNormalization):
+                gamma, beta, mean, var = layer.get_weights()
+                a = gamma / np.sqrt(var + layer.epsilon)
+                pending = (a, beta - mean * a)
+            elif isinstance(layer, Dense):
+                W, b = layer.get_weights()
+                if pending is not None:
+                    a, c = pending
+                    W, b = a[:, None] * W, b + c @ W
+                    pending = None
+                dense = Dense(layer.units, activation=layer.activation, dtype='float32')
+                layers.append(dense)
+                weights.append((dense, [W, b]))
+            elif isinstance(layer, Activation):
+                layers.append(Activation(layer.activation, dtype='float32'))
+            # Dropout is the identity at inference
+        
+        fused = Sequential(layers)
+        for dense, dense_weights in weights:
+            dense.set_weights(dense_weights)
+        
+        # The fold is exact up to rounding
+        sample = self.X_nn[:n_check]
+        tol = _proba_tolerance()
+        expected = np.asarray(self.nn_model(sample, training=False), dtype=np.float64)
+        error = np.max(np.abs(np.asarray(fused(sample), dtype=np.float64) - expected))
+        if error > tol:
+            raise ValueError(f"Fused meta-learner disagrees with the trained model "
+                             f"(max |Δproba| = {error:.2e})")
+        print(f"✓ Fused meta-learner: max |Δproba| = {error:.2e}")
+        return fused
+        
+    def compile_inference(self, n_check=256, tol=1e-4):
+        """Export every base model to flat tree arrays for the JIT scorer"""
+        sample = np.ascontiguousarray(self.X_scaled[:n_check])
+        self.forests = {}
+        for model, name in zip(self.base_models, self.base_names):
+            forest = _extract_forest(model)
+            # Any extraction mistake (threshold side, bit order, NaN routing,
+            # intercept) shows up as a margin mismatch against the native path
+            margins = np.empty(len(sample))
+            forest_margins(forest, sample, margins)
+            error = np.max(np.abs(_predict_meta(model, sample) - margins))
+            if error > tol:
+                raise ValueError(f"{name} forest export disagrees with native margins "
+                                 f"(max |Δmargin| = {error:.2e})")
+            self.forests[name] = forest
+            print(f"✓ {name}: {len(forest['tree_offsets']) - 1} trees, max |Δmargin| = {error:.2e}")
+        
+    def save_model(self, output_dir='stacking_ensemble_model', pickle_base_models=False, n_check=256):
         """Save all model components"""
         os.makedirs(output_dir, exist_ok=True)
+        sample = np.ascontiguousarray(self.X_scaled[:n_check])
         
-        # NN model
-        self.nn_model.save(os.path.join(output_dir, 'nn_meta_learner.h5'))
+        # NN model, with BN folded into the Dense weights
+        self.fuse_nn().save(os.path.join(output_dir, 'nn_meta_learner.h5'))
         
-        # Base models
+        # Base models for predict.py: flattened forests (Numba) and ONNX;
+        # pickles only on request
+        n_features = len(self.features)
+        onnx_models = []
         for model, name in zip(self.base_models, self.base_names):
-            with open(os.path.join(output_dir, f'base_model_{name.lower()}.pkl'), 'wb') as f:
-                pickle.dump(model, f)
-        
-        # Scaler
-        with open(os.path.join(output_dir, 'scaler.pkl'), 'wb') as f:
-            pickle.dump(self.scaler, f)
+            onnx_path = os.path.join(output_dir, f'base_model_{name.lower()}.onnx')
+            _export_onnx(model, onnx_path, n_features)
+            # Converters can drop the intercept (e.g. XGBoost base_score) or
+            # keep a sigmoid, so only ONNX files matching the native margins
+            # are listed for predict.py; the forest export is unaffected
+            session = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+            native = _predict_meta(model, sample)
+            error = np.max(np.abs(onnx_margins(session, sample) - native))
+            if error <= 1e-4 * max(1.0, np.max(np.abs(native))):
+                onnx_models.append(name)
+            else:
+                print(f"⚠ {name} ONNX export disagrees with native margins "
+                      f"(max |Δmargin| = {error:.2e}); the onnx backend will refuse it")
+            if pickle_base_models:
+                with open(os.path.join(output_dir, f'base_model_{name.lower()}.pkl'), 'wb') as f:
+                    pickle.dump(model, f)
+            np.savez(os.path.join(output_dir, f'base_model_{name.lower()}_forest.npz'),
+                     **self.forests[name])
+        
+        # Scaler as plain float64 (mean, scale) vectors, so predict.py can
+        # reproduce StandardScaler.transform bit for bit
+        np.savez(os.path.join(output_dir, 'scaler.npz'),
+                 mean=self.scaler.mean_.astype(np.float64),
+                 scale=self.scaler.scale_.astype(np.float64))
+        
+        self.onnx_models = onnx_models
         
         # Config
         config = {
             'features': self.features,
             'base_models': self.base_names,
+            'base_model_output': 'raw_margin',
+            'base_model_formats': ['forest', 'onnx'],
+            'onnx_models': onnx_models,
             'performance': self.metrics
         }
         with open(os.path.join(output_dir, 'config.json'), 'w') as f:
@@ -202,6 +683,33 @@ class StackingEnsembleTrainer:
         
         print(f"✓ Model saved to {output_dir}/")
         
+    def verify_export(self, output_dir='stacking_ensemble_model', n_check=256):
+        """Send raw CSV rows through predict.py and compare with the trainer"""
+        X_raw, _ = self._load_dataset()
+        X_raw = X_raw.iloc[:n_check]
+        sample = np.ascontiguousarray(self.X_scaled[:n_check])
+        
+        # Split thresholds sit exactly on training values, so inference
+        # scaling has to match the cached matrix exactly, not just closely
+        X_nn = np.empty((len(sample), sample.shape[1] + len(self.base_models)), dtype=np.float32)
+        X_nn[:, :sample.shape[1]] = sample
+        for j, model in enumerate(self.base_models):
+            X_nn[:, sample.shape[1] + j] = _predict_meta(model, sample)
+        expected = np.asarray(self.nn_model(X_nn, training=False), dtype=np.float64).ravel()
+        
+        backends = ['forest']
+        if set(self.onnx_models) == set(self.base_names):
+            backends.append('onnx')
+        for backend in backends:
+            predictor = StackingEnsemblePredictor(output_dir, backend=backend)
+            if not np.array_equal(predictor.transform(X_raw), sample, equal_nan=True):
+                raise ValueError("predict.py scaling does not reproduce the training matrix")
+            error = np.max(np.abs(predictor.predict_proba(X_raw) - expected))
+            if error > _proba_tolerance():
+                raise ValueError(f"predict.py ({backend}) disagrees with the trainer "
+                                 f"(max |Δproba| = {error:.2e})")
+            print(f"✓ predict.py ({backend}): max |Δproba| = {error:.2e}")
+        
     def train(self):
         """Run full training pipeline"""
         print("="*60)
@@ -214,7 +722,9 @@ class StackingEnsembleTrainer:
         self.build_nn()
         self.train_nn()
         self.evaluate()
+        self.compile_inference()
         self.save_model()
+        self.verify_export()
         
         print("\nTraining completed!")
 